@@ -4,17 +4,68 @@
     by Wes, 2025
 """
 
-from glob import glob
+import bisect
+import codecs
 import io
+import logging
 import os
 from os import path
 import re
+import stat
 import struct
-import sys
 import tempfile
 import time
 import zlib
 
+try:
+    import deflate as _libdeflate
+except ImportError:
+    _libdeflate = None
+
+# Streaming compression backend, ISA-L when available (its best level is 3)
+try:
+    from isal import isal_zlib as _stream_zlib
+    _STREAM_LEVEL = _stream_zlib.ISAL_BEST_COMPRESSION
+except ImportError:
+    _stream_zlib = zlib
+    _STREAM_LEVEL = 9
+
+_log = logging.getLogger(__name__)
+
+# Not available on Windows
+_pread = getattr(os, 'pread', None)
+
+# Read size used when streaming files into the archive
+_CHUNK_SIZE = 256 * 1024
+
+# Buffer size of the temporary file holding the archived file contents
+_MEM_BUFFER_SIZE = 1 << 20
+
+# File contents are kept in memory until they grow past this, then go to disk
+_MEM_SPILL_SIZE = 512 * 1024 * 1024
+
+# Read buffer size for archives loaded by add_mrs
+_ARCHIVE_BUFFER_SIZE = 64 * 1024
+
+# Largest file compressed in one shot with libdeflate, bigger ones are streamed
+_LIBDEFLATE_MAX_SIZE = 64 * 1024 * 1024
+
+# Files smaller than this, or already compressed formats, are stored as-is
+_MIN_DEFLATE_SIZE = 64
+_STORED_EXTS = frozenset({
+    '.7z',  '.bz2', '.gif', '.gz',  '.jpeg', '.jpg', '.mp3', '.mp4',
+    '.mrs', '.ogg', '.png', '.rar', '.webp', '.xz',  '.zip'
+})
+# Leading bytes of already compressed formats, for files with other extensions
+_STORED_MAGICS = (
+    b'\xff\xd8\xff', b'\x89PNG', b'GIF8', b'PK\x03\x04', b'OggS', b'\x1f\x8b',
+    b'BZh', b'\xfd7zXZ\x00', b'7z\xbc\xaf\x27\x1c', b'Rar!\x1a\x07', b'fLaC', b'ID3'
+)
+
+# Byte-for-byte translation tables for the default cipher
+_DEC_TABLE = bytes((~((c >> 3) | (c << 5))) & 0xFF for c in range(256))
+_ENC_TABLE = bytes(((c << 3) | (c >> 5)) & 0xFF for c in ((~i) & 0xFF for i in range(256)))
+
 class NotAMrsFileError(IOError):
     super
 
@@ -24,99 +75,175 @@ class InvalidMrsEncryptionError(IOError):
 class NotAssigned:
     pass
 
+def _lookup_codecs(*names: str) -> tuple[str, ...]:
+    found = []
+    for i in names:
+        try:
+            codecs.lookup(i)
+        except LookupError:
+            continue
+        found.append(i)
+    return tuple(found)
+
+# File name encodings, in order of preference ('mbcs' only exists on Windows)
+_FILENAME_CODECS = _lookup_codecs('mbcs', '1252', 'utf-8')
+
 def _dec_str(s: bytes):
-    try:
-        ss = s.decode('mbcs')
-        return (ss, 'mbcs')
-    except:
+    # ASCII is a subset of every codec in the chain, so report the preferred one
+    if s.isascii():
+        return (s.decode('ascii'), _FILENAME_CODECS[0])
+    for enc in _FILENAME_CODECS:
         try:
-            ss = s.decode('1252')
-            return (ss, '1252')
-        except:
-            try:
-                ss = s.decode('utf-8')
-                return (ss, 'utf-8')
-            except:
-                raise UnicodeError(f'Unknown encoding.')
+            return (s.decode(enc), enc)
+        except UnicodeDecodeError:
+            continue
+    raise UnicodeError('Unknown encoding.')
 
 def _enc_str(s: str):
-    try:
-        ss = s.encode('mbcs')
-        return (ss, 'mbcs')
-    except:
+    if s.isascii():
+        return (s.encode('ascii'), _FILENAME_CODECS[0])
+    for enc in _FILENAME_CODECS:
         try:
-            ss = s.encode('1252')
-            return (ss, '1252')
-        except:
-            try:
-                ss = s.encode('utf-8')
-                return (ss, 'utf-8')
-            except:
-                raise UnicodeError('Unknown encoding.')
+            return (s.encode(enc), enc)
+        except UnicodeEncodeError:
+            continue
+    raise UnicodeError('Unknown encoding.')
+
+_INVALID_NAMES = frozenset({
+    '.',    '..',
+    'CON',  'PRN',  'AUX',  'NUL',  'COM0', 'COM1', 'COM2', 'COM3',
+    'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 'COM¹', 'COM²',
+    'COM³', 'LPT0', 'LPT1', 'LPT2', 'LPT3', 'LPT4', 'LPT5', 'LPT6',
+    'LPT7', 'LPT8', 'LPT9', 'LPT¹', 'LPT²', 'LPT³'
+})
+
+_INVALID_CHARS_RE = re.compile(r'[<>:"|?*\x00-\x1f]')
 
 def _is_valid_filename(f: str):
-    invalid_names = [
-        '.',    '..',
-        'CON',  'PRN',  'AUX',  'NUL',  'COM0', 'COM1', 'COM2', 'COM3',
-        'COM4', 'COM5', 'COM6', 'COM7', 'COM8', 'COM9', 'COM¹', 'COM²',
-        'COM³', 'LPT0', 'LPT1', 'LPT2', 'LPT3', 'LPT4', 'LPT5', 'LPT6',
-        'LPT7', 'LPT8', 'LPT9', 'LPT¹', 'LPT²', 'LPT³'
-    ]
-    invalid_chars = ['<', '>', ':', '"', '|', '?', '*']
-    invalid_chars.extend(range(1, 32))
-
-    for i in invalid_chars:
-        if type(i) == int:
-            i = chr(i)
-        if i in f:
-            raise UnicodeError
+    if _INVALID_CHARS_RE.search(f):
+        raise UnicodeError
 
     dirs = f.split('\\')
     for i in dirs:
         fname = path.splitext(i)[0]
-        if fname.upper() in invalid_names:
+        if fname.upper() in _INVALID_NAMES:
             raise UnicodeError
 
+def _split_name(name: str) -> tuple[str, str, int]:
+    # Splits "name (num).ext" into its parts, keeping at least one character of name
+    fext = ''
+    dot = name.rfind('.')
+    if dot > 0 and dot < len(name) - 1:
+        fext = name[dot:]
+        name = name[:dot]
+    if name.endswith(')'):
+        i = name.rfind('(')
+        if i > 1 and name[i - 1].isspace() and name[i + 1:-1].isdecimal():
+            return (name[:i - 1], fext, int(name[i + 1:-1]))
+    return (name, fext, 0)
+
+def _dupe_key(name: str):
+    (fname, fext, fnum) = _split_name(name)
+    return ((fname.lower(), fext.lower()), fname, fext, fnum)
+
+def _first_free_num(nums: list[int], start: int = 2) -> int:
+    # nums is sorted and unique, so nums[base + j] >= start + j holds for every
+    # j and the first free number sits right after the longest gapless run
+    base = bisect.bisect_left(nums, start)
+    lo = base
+    hi = len(nums)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if nums[mid] == start + (mid - base):
+            lo = mid + 1
+        else:
+            hi = mid
+    return start + (lo - base)
+
+def _is_valid_deflate(b: bytes) -> bool:
+    # Inflate in bounded steps and throw the output away, only the check matters
+    dobj = zlib.decompressobj(-15)
+    try:
+        while True:
+            out = dobj.decompress(b, _CHUNK_SIZE)
+            b = dobj.unconsumed_tail
+            if dobj.eof or (not out and not b):
+                break
+    except zlib.error:
+        return False
+    return dobj.eof
+
+def _walk_files(root: str):
+    # Depth-first, in directory order and skipping hidden entries, like glob('**')
+    stack = [('', os.scandir(root))]
+    try:
+        while stack:
+            (rel, it) = stack[-1]
+            entry = next(it, None)
+            if entry is None:
+                it.close()
+                stack.pop()
+                continue
+            if entry.name.startswith('.'):
+                continue
+            relpath = path.join(rel, entry.name) if rel else entry.name
+            if entry.is_dir():
+                try:
+                    stack.append((relpath, os.scandir(entry.path)))
+                except OSError:
+                    pass
+                continue
+            yield (entry.path, relpath, entry)
+    finally:
+        for (_, it) in stack:
+            it.close()
+
 ######## _dostime ##############################################
 class _dostime:
     class _time:
+        __slots__ = ('value',)
+
         def __init__(self):
-            self.hour   = 0
-            self.minute = 0
-            self.second = 0
-            self.value  = 0
+            self.value = 0
+        
+        @property
+        def hour(self) -> int:
+            return (self.value >> 11) & 0b11111
+        
+        @property
+        def minute(self) -> int:
+            return (self.value >> 5) & 0b111111
         
-        def set_time(self, tm: time.struct_time|int):
-            if isinstance(tm, time.struct_time):
-                self.hour   = int(tm.tm_hour)
-                self.minute = int(tm.tm_min)
-                self.second = int(tm.tm_sec / 2)
-                self.value = (self.second & 0b11111) | ((self.minute & 0b111111) << 5) | ((self.hour & 0b11111) << 11)
-            elif isinstance(tm, int):
-                self.hour   = int((tm & 0b11111) >> 11)
-                self.minute = int((tm & 0b111111) >> 5)
-                self.second = int(tm & 0b11111)
-                self.value  = tm
+        @property
+        def second(self) -> int:
+            return self.value & 0b11111
+        
+        def set_from_struct_time(self, tm: time.struct_time):
+            self.value = ((tm.tm_sec // 2) & 0b11111) | ((tm.tm_min & 0b111111) << 5) | ((tm.tm_hour & 0b11111) << 11)
         
     class _date:
+        __slots__ = ('value',)
+
         def __init__(self):
-            self.year  = 0
-            self.month = 0
-            self.day   = 0
             self.value = 0
         
-        def set_date(self, tm: time.struct_time|int):
-            if isinstance(tm, time.struct_time):
-                self.year  = int(tm.tm_year - 1980)
-                self.month = int(tm.tm_mon)
-                self.day   = int(tm.tm_mday)
-                self.value = (self.day & 0b11111) | ((self.month & 0b1111) << 5) | ((self.year & 0b1111111) << 9)
-            elif isinstance(tm, int):
-                self.year  = int((tm & 0b1111111) >> 9)
-                self.month = int((tm & 0b1111) >> 5)
-                self.day   = int(tm & 0b11111)
-                self.value = tm
+        @property
+        def year(self) -> int:
+            return (self.value >> 9) & 0b1111111
+        
+        @property
+        def month(self) -> int:
+            return (self.value >> 5) & 0b1111
+        
+        @property
+        def day(self) -> int:
+            return self.value & 0b11111
         
+        def set_from_struct_time(self, tm: time.struct_time):
+            self.value = (tm.tm_mday & 0b11111) | ((tm.tm_mon & 0b1111) << 5) | (((tm.tm_year - 1980) & 0b1111111) << 9)
+        
+    __slots__ = ('time', 'date')
+
     def __init__(self):
         self.time = self._time()
         self.date = self._date()
@@ -132,8 +259,13 @@ class _dostime:
         else:
             tm = time.localtime(time.time())
 
-        self.time.set_time(tm)
-        self.date.set_date(tm)
+        self.time.set_from_struct_time(tm)
+        self.date.set_from_struct_time(tm)
+    
+    def from_dos(self, dos_time: int, dos_date: int):
+        # Already DOS-packed (as stored on disk), no need to go through localtime
+        self.time.value = dos_time
+        self.date.value = dos_date
     
     def mktimedos(self) -> time.time:
         tm = time.struct_time([
@@ -153,10 +285,18 @@ class _mrs_hdr:
     MAGIC2 = 0x5030208
     MAGIC3 = 0x6054b50
     
-    size = 22
-
     __fmt = "<IHHHHIIH"
 
+    _STRUCT = struct.Struct(__fmt)
+    _pack        = _STRUCT.pack
+    _pack_into   = _STRUCT.pack_into
+    _unpack_from = _STRUCT.unpack_from
+
+    size = _STRUCT.size
+
+    __slots__ = ('signature', 'disk_num', 'disk_start', 'dir_count', 'total_dir_count',
+                 'dir_size', 'dir_offset', 'comment_length')
+
     def __init__(self):
         self.signature       = self.MAGIC2
         self.disk_num        = 0
@@ -168,14 +308,14 @@ class _mrs_hdr:
         self.comment_length  = 0
 
     def __bytes__(self) -> bytes:
-        b = struct.pack(self.__fmt, self.signature,
-                                    self.disk_num,
-                                    self.disk_start,
-                                    self.dir_count,
-                                    self.total_dir_count,
-                                    self.dir_size,
-                                    self.dir_offset,
-                                    self.comment_length)
+        b = self._pack(self.signature,
+                       self.disk_num,
+                       self.disk_start,
+                       self.dir_count,
+                       self.total_dir_count,
+                       self.dir_size,
+                       self.dir_offset,
+                       self.comment_length)
         return b
     
     def dump(self):
@@ -190,16 +330,14 @@ class _mrs_hdr:
         print('  comment_length  %u' % self.comment_length)
     
     def read(self, f: io.BufferedIOBase|bytes|bytearray):
-        b = NotAssigned
         if isinstance(f, io.BufferedIOBase):
-            b = f.read(self.size)
-        elif isinstance(f, bytes):
-            b = f
-        elif isinstance(f, bytearray):
-            b = bytes(f)
+            self._read_bytes(f.read(self.size))
+        elif isinstance(f, (bytes, bytearray)):
+            self._read_bytes(f)
         else:
             raise TypeError(f'"f" MUST be a io.BufferedIOBase, bytes or bytearray.')
-        
+    
+    def _read_bytes(self, b: bytes|bytearray):
         ( self.signature,
           self.disk_num,
           self.disk_start,
@@ -207,18 +345,19 @@ class _mrs_hdr:
           self.total_dir_count,
           self.dir_size,
           self.dir_offset,
-          self.comment_length ) = struct.unpack_from(self.__fmt, b)
+          self.comment_length ) = self._unpack_from(b)
     
     def write(self) -> bytearray:
-        b = struct.pack( self.__fmt, self.signature,
-                                     self.disk_num,
-                                     self.disk_start,
-                                     self.dir_count,
-                                     self.total_dir_count,
-                                     self.dir_size,
-                                     self.dir_offset,
-                                     self.comment_length )
-        return bytearray(b)
+        b = bytearray(self.size)
+        self._pack_into( b, 0, self.signature,
+                               self.disk_num,
+                               self.disk_start,
+                               self.dir_count,
+                               self.total_dir_count,
+                               self.dir_size,
+                               self.dir_offset,
+                               self.comment_length )
+        return b
 
 ######## _mrs_local_hdr ########################################
 class _mrs_local_hdr:
@@ -226,10 +365,18 @@ class _mrs_local_hdr:
     MAGIC2  = 0x85840000
     VER     = 0x14
 
-    size = 30
-
     __fmt = "<IHHHHHIIIHH"
 
+    _STRUCT = struct.Struct(__fmt)
+    _pack_into   = _STRUCT.pack_into
+    _unpack_from = _STRUCT.unpack_from
+
+    size = _STRUCT.size
+
+    __slots__ = ('signature', 'version', 'flags', 'compression', 'filetime', 'crc32',
+                 'compressed_size', 'uncompressed_size', 'filename_length', 'extra_length',
+                 'filename', 'extra')
+
     def __init__(self):
         self.signature         = 0
         self.version           = 0
@@ -262,16 +409,14 @@ class _mrs_local_hdr:
             print('  extra             %s' % self.extra)
     
     def read(self, f: io.BufferedIOBase|bytes|bytearray):
-        b = NotAssigned
         if isinstance(f, io.BufferedIOBase):
-            b = f.read(self.size)
-        elif isinstance(f, bytes):
-            b = f
-        elif isinstance(f, bytearray):
-            b = bytes(f)
+            self._read_bytes(f.read(self.size))
+        elif isinstance(f, (bytes, bytearray)):
+            self._read_bytes(f)
         else:
             raise TypeError(f'"f" MUST be a io.BufferedIOBase, bytes or bytearray.')
-        
+    
+    def _read_bytes(self, b: bytes|bytearray):
         ( self.signature,
           self.version,
           self.flags,
@@ -282,26 +427,26 @@ class _mrs_local_hdr:
           self.compressed_size,
           self.uncompressed_size,
           self.filename_length,
-          self.extra_length ) = struct.unpack_from(self.__fmt, b)
+          self.extra_length ) = self._unpack_from(b)
         
         offset = self.size
 
-        self.filetime.time.set_time(_ftime)
-        self.filetime.date.set_date(_fdate)
+        self.filetime.from_dos(_ftime, _fdate)
     
     def write(self) -> bytearray:
-        b = struct.pack( self.__fmt, self.signature,
-                                     self.version,
-                                     self.flags,
-                                     self.compression,
-                                     self.filetime.time.value,
-                                     self.filetime.date.value,
-                                     self.crc32,
-                                     self.compressed_size,
-                                     self.uncompressed_size,
-                                     self.filename_length,
-                                     self.extra_length )
-        return bytearray(b)
+        b = bytearray(self.size)
+        self._pack_into( b, 0, self.signature,
+                               self.version,
+                               self.flags,
+                               self.compression,
+                               self.filetime.time.value,
+                               self.filetime.date.value,
+                               self.crc32,
+                               self.compressed_size,
+                               self.uncompressed_size,
+                               self.filename_length,
+                               self.extra_length )
+        return b
 
 ######## _mrs_central_dir_hdr ##################################
 class _mrs_central_dir_hdr:
@@ -310,10 +455,19 @@ class _mrs_central_dir_hdr:
     VER_MADE   = 0x19
     VER_NEEDED = 0x14
 
-    size = 46
-
     __fmt = "<IHHHHHHIIIHHHHHII"
 
+    _STRUCT = struct.Struct(__fmt)
+    _pack_into   = _STRUCT.pack_into
+    _unpack_from = _STRUCT.unpack_from
+
+    size = _STRUCT.size
+
+    __slots__ = ('signature', 'version_made', 'version_needed', 'flags', 'compression',
+                 'filetime', 'crc32', 'compressed_size', 'uncompressed_size',
+                 'filename_length', 'extra_length', 'comment_length', 'disk_start',
+                 'int_attr', 'ext_attr', 'offset', 'filename', 'extra', 'comment')
+
     def __init__(self):
         self.signature         = 0
         self.version_made      = 0
@@ -335,17 +489,15 @@ class _mrs_central_dir_hdr:
         self.extra             = None
         self.comment           = None
     
-    def read(self, f: io.BufferedIOBase|bytes|bytearray):
-        b = NotAssigned
+    def read(self, f: io.BufferedIOBase|bytes|bytearray, offset: int = 0):
         if isinstance(f, io.BufferedIOBase):
-            b = f.read(self.size)
-        elif isinstance(f, bytes):
-            b = f
-        elif isinstance(f, bytearray):
-            b = bytes(f)
+            self._read_bytes(f.read(self.size))
+        elif isinstance(f, (bytes, bytearray)):
+            self._read_bytes(f, offset)
         else:
             raise TypeError(f'"f" MUST be a io.BufferedIOBase, bytes or bytearray.')
-        
+    
+    def _read_bytes(self, b: bytes|bytearray|memoryview, offset: int = 0):
         ( self.signature,
           self.version_made,
           self.version_needed,
@@ -362,43 +514,72 @@ class _mrs_central_dir_hdr:
           self.disk_start,
           self.int_attr,
           self.ext_attr,
-          self.offset ) = struct.unpack_from(self.__fmt, b)
+          self.offset ) = self._unpack_from(b, offset)
         
-        offset = self.size
+        offset += self.size
         
-        self.filetime.time.set_time(_ftime)
-        self.filetime.date.set_date(_fdate)
+        self.filetime.from_dos(_ftime, _fdate)
 
         if self.filename_length:
-            self.filename = b[offset:(offset + self.filename_length)]
+            self.filename = bytes(b[offset:(offset + self.filename_length)])
             offset += self.filename_length
         
         if self.extra_length:
-            self.extra = b[offset:(offset + self.extra_length)]
+            self.extra = bytes(b[offset:(offset + self.extra_length)])
             offset += self.extra_length
         
         if self.comment_length:
-            self.comment = b[offset:(offset + self.comment_length)]
+            self.comment = bytes(b[offset:(offset + self.comment_length)])
     
     def write(self) -> bytearray:
-        b = struct.pack(self.__fmt, self.signature,
-                                    self.version_made,
-                                    self.version_needed,
-                                    self.flags,
-                                    self.compression,
-                                    self.filetime.time.value,
-                                    self.filetime.date.value,
-                                    self.crc32,
-                                    self.compressed_size,
-                                    self.uncompressed_size,
-                                    self.filename_length,
-                                    self.extra_length,
-                                    self.comment_length,
-                                    self.disk_start,
-                                    self.int_attr,
-                                    self.ext_attr,
-                                    self.offset)
-        return bytearray(b)
+        b = bytearray(self.size)
+        self._pack_into(b, 0, self.signature,
+                              self.version_made,
+                              self.version_needed,
+                              self.flags,
+                              self.compression,
+                              self.filetime.time.value,
+                              self.filetime.date.value,
+                              self.crc32,
+                              self.compressed_size,
+                              self.uncompressed_size,
+                              self.filename_length,
+                              self.extra_length,
+                              self.comment_length,
+                              self.disk_start,
+                              self.int_attr,
+                              self.ext_attr,
+                              self.offset)
+        return b
+    
+    def record_size(self) -> int:
+        return self.size + len(self.filename) + (len(self.extra) if self.extra else 0) + (len(self.comment) if self.comment else 0)
+    
+    def write_into(self, b: bytearray, pos: int, offset: int) -> int:
+        # Packs the whole record at b[pos:], with offset in place of self.offset
+        self._pack_into(b, pos, self.signature,
+                                self.version_made,
+                                self.version_needed,
+                                self.flags,
+                                self.compression,
+                                self.filetime.time.value,
+                                self.filetime.date.value,
+                                self.crc32,
+                                self.compressed_size,
+                                self.uncompressed_size,
+                                self.filename_length,
+                                self.extra_length,
+                                self.comment_length,
+                                self.disk_start,
+                                self.int_attr,
+                                self.ext_attr,
+                                offset)
+        pos += self.size
+        for i in (self.filename, self.extra, self.comment):
+            if i:
+                b[pos:(pos + len(i))] = i
+                pos += len(i)
+        return pos
     
     def dump(self):
         print('_mrs_central_dir_hdr dump (%u):' % self.size)
@@ -428,11 +609,14 @@ class _mrs_central_dir_hdr:
 
 ######## _mrs_file #############################################
 class _mrs_file:
+    __slots__ = ('lh', 'dh', 'filenameuc', 'filenameenc', 'namekey')
+
     def __init__(self):
         self.lh = _mrs_local_hdr()
         self.dh = _mrs_central_dir_hdr()
         self.filenameuc = None  # File name in Unicode
         self.filenameenc = None # File name encoding
+        self.namekey = None     # Duplicate index key, as (key, fnum)
     
     def dump(self):
         self.lh.dump()
@@ -516,17 +700,13 @@ class mrs_file:
     @lh_extra.setter
     def lh_extra(self, v: bytearray|bytes|str|None):
         if isinstance(v, bytearray):
-            # print('<bytearray>')
             self.__lhextra = bytes(v)
         elif isinstance(v, bytes):
-            # print('<bytes>')
             self.__lhextra = bytes(v)
         elif isinstance(v, str):
-            # print('<str>')
             self.__lhextra = v.encode('utf-8', 'ignore')
         elif v == None:
             self.__lhextra = None
-            # print('<none>')
         else:
             raise TypeError('lh_extra MUST be a bytearray, bytes, str or None')
     
@@ -537,17 +717,13 @@ class mrs_file:
     @dh_extra.setter
     def dh_extra(self, v: bytearray|bytes|str|None):
         if isinstance(v, bytearray):
-            # print('<bytearray>')
             self.__dhextra = bytes(v)
         elif isinstance(v, bytes):
-            # print('<bytes>')
             self.__dhextra = bytes(v)
         elif isinstance(v, str):
-            # print('<str>')
             self.__dhextra = v.encode('utf-8', 'ignore')
         elif v == None:
             self.__dhextra = None
-            # print('<none>')
         else:
             raise TypeError('dh_extra MUST be a bytearray, bytes, str or None')
     
@@ -558,17 +734,13 @@ class mrs_file:
     @dh_comment.setter
     def dh_comment(self, v: bytearray|bytes|str|None):
         if isinstance(v, bytearray):
-            # print('<bytearray>')
             self.__dhcomment = bytes(v)
         elif isinstance(v, bytes):
-            # print('<bytes>')
             self.__dhcomment = bytes(v)
         elif isinstance(v, str):
-            # print('<str>')
             self.__dhcomment = v.encode('utf-8', 'ignore')
         elif v == None:
             self.__dhcomment = None
-            # print('<none>')
         else:
             raise TypeError('dh_comment MUST be a bytearray, bytes, str or None')
 
@@ -639,31 +811,27 @@ class mrs:
 
     def __init__(self):
         self.__files: list[_mrs_file] = []
+        self.__name_index: dict[tuple[str, str], dict[int, list[int]]] = {}
+        self.__name_nums: dict[tuple[str, str], list[int]] = {}
         self.__hdr      = _mrs_hdr()
-        self.__mem      = tempfile.TemporaryFile('w+b')
+        self.__mem      = io.BytesIO()
+        self.__mem_end  = 0
+        self.__mem_disk = False
+        self.__mem_dirty = False
         self.__decrypt  = mrs_encryption()
         self.__encrypt  = mrs_encryption()
         self.__sigcheck = None
+        self.__chunk    = memoryview(bytearray(_CHUNK_SIZE))
     
     def __del__(self):
         if not self.__mem.closed:
             self.__mem.close()
     
-    def __mrs_default_decrypt(self, buffer: bytes, size: int):
-        buf = bytearray(buffer)
-        for i in range(size):
-            c = buf[i]
-            c = ((c >> 3) | (c << 5)) & 0xFF
-            buf[i] = (~c) & 0xFF
-        return bytes(buf)
-    
-    def __mrs_default_encrypt(self, buffer: bytes, size: int):
-        buf = bytearray(buffer)
-        for i in range(size):
-            c = (~buf[i]) & 0xFF
-            c = ((c << 3) | (c >> 5)) & 0xFF
-            buf[i] = c
-        return bytes(buf)
+    def __mrs_default_decrypt(self, buffer: bytes, size: int) -> bytes:
+        return buffer.translate(_DEC_TABLE)
+    
+    def __mrs_default_encrypt(self, buffer: bytes, size: int) -> bytes:
+        return buffer.translate(_ENC_TABLE)
     
     def __mrs_default_signatures(self, where: int, signature: int) -> bool:
         if not isinstance(signature, int):
@@ -680,77 +848,138 @@ class mrs:
                 return True
         return False
     
+    def __mem_check(self, offset: int, bufsize: int):
+        if offset < 0 or offset + bufsize > self.__mem_end:
+            raise BufferError('Offset %08x(%u) is invalid.' % (offset, offset))
+    
     def __mem_read(self, offset: int, bufsize: int) -> bytes:
-        self.__mem.seek(0, io.SEEK_END)
-        sz = self.__mem.tell()
-        if offset >= sz:
-            raise BufferError('Offset %08x(%u) is invalid.')
+        self.__mem_check(offset, bufsize)
+        if self.__mem_dirty:
+            self.__mem.flush()
+            self.__mem_dirty = False
+        if self.__mem_disk and _pread is not None:
+            # Positional read, one syscall and the file position is left alone
+            return _pread(self.__mem.fileno(), bufsize, offset)
         self.__mem.seek(offset, io.SEEK_SET)
-        buf = self.__mem.read(bufsize)
-        self.__mem.seek(0, io.SEEK_END)
-        return buf
+        return self.__mem.read(bufsize)
+    
+    def __mem_spill(self):
+        # Moves the archived file contents from memory to a temporary file
+        f = tempfile.TemporaryFile('w+b', buffering=_MEM_BUFFER_SIZE)
+        with self.__mem.getbuffer() as b:
+            f.write(b[:self.__mem_end])
+        self.__mem.close()
+        self.__mem = f
+        self.__mem_disk = True
+        _log.debug('Spilled %u bytes of file contents to disk', self.__mem_end)
+    
+    def __mem_write(self, b: bytes):
+        if not self.__mem_disk and self.__mem_end + len(b) > _MEM_SPILL_SIZE:
+            self.__mem_spill()
+        # Reads may leave the file position wherever they stopped
+        if self.__mem.tell() != self.__mem_end:
+            self.__mem.seek(self.__mem_end, io.SEEK_SET)
+        self.__mem.write(b)
+        self.__mem_end += len(b)
+        self.__mem_dirty = True
+    
+    def __index_name(self, index: int):
+        f = self.__files[index]
+        (key, _, _, fnum) = _dupe_key(f.filenameuc)
+        f.namekey = (key, fnum)
+        exact = self.__name_index.setdefault(key, {})
+        if fnum not in exact:
+            bisect.insort(self.__name_nums.setdefault(key, []), fnum)
+            exact[fnum] = []
+        # Names are not guaranteed unique (set_file, KEEP_BOTH within a batch),
+        # so every index sharing a name is kept, sorted
+        bisect.insort(exact[fnum], index)
+    
+    def __unindex_name(self, index: int):
+        (key, fnum) = self.__files[index].namekey
+        exact = self.__name_index.get(key)
+        indexes = exact.get(fnum) if exact else None
+        if not indexes:
+            return
+        i = bisect.bisect_left(indexes, index)
+        if i == len(indexes) or indexes[i] != index:
+            return
+        del indexes[i]
+        if not indexes:
+            del exact[fnum]
+            nums = self.__name_nums[key]
+            del nums[bisect.bisect_left(nums, fnum)]
+            if not exact:
+                del self.__name_index[key]
+                del self.__name_nums[key]
+    
+    def __mem_extract(self, f: _mrs_file, out: io.BufferedIOBase):
+        # Streams an entry's contents to out without holding the whole file
+        dobj = zlib.decompressobj(-15) if f.dh.compression == mrs.COMPRESSION_DEFLATE else None
+        offset = f.dh.offset
+        remaining = f.dh.compressed_size
+        while remaining:
+            chunk = self.__mem_read(offset, min(remaining, _CHUNK_SIZE))
+            offset += len(chunk)
+            remaining -= len(chunk)
+            if not dobj:
+                out.write(chunk)
+                continue
+            while chunk:
+                out.write(dobj.decompress(chunk, _CHUNK_SIZE))
+                chunk = dobj.unconsumed_tail
+        if dobj:
+            out.write(dobj.flush())
+    
+    def __mem_deflate(self, fp: io.BufferedIOBase, fsize: int) -> tuple[int, int]:
+        if _libdeflate is not None and fsize <= _LIBDEFLATE_MAX_SIZE:
+            buf = fp.read()
+            cbuf = _libdeflate.deflate_compress(buf, 12)
+            self.__mem_write(cbuf)
+            return (_libdeflate.crc32(buf), len(cbuf))
+
+        crc = 0
+        csize = 0
+        cobj = _stream_zlib.compressobj(_STREAM_LEVEL, _stream_zlib.DEFLATED, -15)
+        while True:
+            n = fp.readinto(self.__chunk)
+            if not n:
+                break
+            chunk = self.__chunk[:n]
+            crc = _stream_zlib.crc32(chunk, crc)
+            cchunk = cobj.compress(chunk)
+            if cchunk:
+                self.__mem_write(cchunk)
+                csize += len(cchunk)
+        cchunk = cobj.flush()
+        self.__mem_write(cchunk)
+        csize += len(cchunk)
+        return (crc, csize)
+    
+    def __mem_store(self, fp: io.BufferedIOBase) -> tuple[int, int]:
+        crc = 0
+        csize = 0
+        while True:
+            n = fp.readinto(self.__chunk)
+            if not n:
+                break
+            chunk = self.__chunk[:n]
+            crc = zlib.crc32(chunk, crc)
+            self.__mem_write(chunk)
+            csize += len(chunk)
+        return (crc, csize)
     
     def __is_duplicate(self, name):
-        # print(name)
-        fname = ''
-        fext = ''
-        fnum = 0
-        exact_match = (False, 0)
-        n = []
-
-        p = re.compile('(?P<fname>.+?)(?:\s\((?P<fnum>\d+)\)|)(?P<fext>\.[^.]+?|)$', re.IGNORECASE)
-        r = re.match(p, name)
-        if r:
-            rd = r.groupdict()
-            fnum = int(rd.get('fnum')) if rd.get('fnum') else 0
-            fname = rd.get('fname')
-            fext = rd.get('fext')
-
-        # print(f'Name: {fname}')
-        # print(f'Ext:  {fext}')
-        # print(f'Num:  {fnum}')
+        (key, fname, fext, fnum) = _dupe_key(name)
 
-        for i in self.__files:
-            # print(i.filenameuc)
-            r = re.match(p, i.filenameuc)
-            rd = r.groupdict()
-            f2num = int(rd.get('fnum')) if rd.get('fnum') else 0
-            f2name = rd.get('fname', '')
-            f2ext = rd.get('fext', '')
-            # print(f"{f2num} {f2name} {f2ext}")
-            if (f2name.lower() == fname.lower()) and (f2ext.lower() == fext.lower()):
-                if f2num == fnum:
-                    # print('Exact match!')
-                    exact_match = (True, self.__files.index(i))
-                    continue
-                n.append(f2num)
-                continue
-        
-        if exact_match[0]:
-            fnum = 2
-            n.sort()
-            for i in n:
-                if i == fnum:
-                    fnum += 1
-                elif i != fnum:
-                    # print(f"Found num available: {i}")
-                    break
-            # print('Got n\'s:', n)
-            # print(f'fnum is {fnum}')
-            return (exact_match[1], f'{fname} ({fnum}){fext}')
+        exact = self.__name_index.get(key)
+        if exact and fnum in exact:
+            fnum_free = _first_free_num(self.__name_nums[key])
+            return (exact[fnum][-1], f'{fname} ({fnum_free}){fext}')
         
         return None
     
-    def add_file(self, name: str, /, final_name: str = None, on_dupe: mrs_dupe_behavior = mrs_dupe_behavior.KEEP_NEW):
-        # print('mrs.add_file():')
-        # print(f'Adding file "{name}"')
-
-        real_name = path.realpath(name)
-        # print(f'which real path is "{real_name}"')
-
-        if not final_name:
-            final_name = path.split(real_name)[1]
-        
+    def __add_file(self, name: str, real_name: str, final_name: str, st: os.stat_result|None, on_dupe: mrs_dupe_behavior):
         final_name = final_name.replace('/', '\\')
         try:
             _is_valid_filename(final_name)
@@ -770,29 +999,16 @@ class mrs:
 
         try:
             (final_name, f.filenameenc) = _enc_str(final_name)
-        except:
-            raise UnicodeError('Unknown encoding for final_name.')
-        
-        # try:
-        #     final_name = final_name.encode('mbcs')
-        #     f.filenameenc = 'mbcs'
-        # except:
-        #     try:
-        #         final_name = final_name.encode('1252')
-        #         f.filenameenc = '1252'
-        #     except:
-        #         try:
-        #             final_name = final_name.encode('utf-8')
-        #             f.filenameenc = 'utf-8'
-        #         except:
-        #             raise UnicodeError('Unknown encoding for final_name.')
+        except UnicodeError:
+            raise UnicodeError('Unknown encoding for final_name.') from None
         
-        # print(f'Final name will be "{final_name}"')
-
-        if not path.exists(real_name):
-            raise FileNotFoundError(f'"{name}" was not found.')
+        if st is None:
+            try:
+                st = os.stat(real_name)
+            except OSError:
+                raise FileNotFoundError(f'"{name}" was not found.') from None
 
-        if path.isdir(real_name):
+        if stat.S_ISDIR(st.st_mode):
             raise IsADirectoryError(f'"{name}" is a directory.')
 
         fp = None
@@ -801,14 +1017,17 @@ class mrs:
         except:
             raise IOError(f'Cannot open "{name}".')
         
-        ftime = path.getmtime(fp.fileno())
-        fsize = path.getsize(fp.fileno())
+        ftime = st.st_mtime
+        fsize = st.st_size
 
         f.dh.signature         = _mrs_central_dir_hdr.MAGIC1
         f.dh.version_made      = _mrs_central_dir_hdr.VER_MADE
         f.dh.version_needed    = _mrs_central_dir_hdr.VER_NEEDED
         f.dh.compression       = mrs.COMPRESSION_DEFLATE
         f.dh.uncompressed_size = fsize
+        if (fsize < _MIN_DEFLATE_SIZE or path.splitext(real_name)[1].lower() in _STORED_EXTS
+                or fp.peek(16).startswith(_STORED_MAGICS)):
+            f.dh.compression   = mrs.COMPRESSION_STORE
         f.dh.filename_length   = len(final_name)
         f.dh.filetime.dostime(ftime)
 
@@ -819,86 +1038,84 @@ class mrs:
         f.lh.filename_length   = f.dh.filename_length
         f.lh.filetime          = f.dh.filetime
 
-        buf = fp.read()
+        f.dh.offset = self.__mem_end
 
-        fp.close()
-        
-        cbuf = None
-        if fsize > 0:
-            f.dh.crc32 = zlib.crc32(buf)
-            f.lh.crc32 = f.dh.crc32
-            try:
-                # print(buf)
-                cobj = zlib.compressobj(9, zlib.DEFLATED, -15)
-                cobj.compress(buf)
-                cbuf = cobj.flush()
-            except:
-                cbuf = buf
+        if f.dh.compression == mrs.COMPRESSION_DEFLATE:
+            (crc, csize) = self.__mem_deflate(fp, fsize)
+            if csize >= fsize:
+                # DEFLATE did not pay off, store the file as-is instead
+                self.__mem.seek(f.dh.offset, io.SEEK_SET)
+                self.__mem.truncate()
+                self.__mem_end = f.dh.offset
+                fp.seek(0, io.SEEK_SET)
                 f.dh.compression = mrs.COMPRESSION_STORE
-        else:
-            cbuf = buf
-            f.dh.compression = mrs.COMPRESSION_STORE
-        
-        buf = None
+        if f.dh.compression == mrs.COMPRESSION_STORE:
+            (crc, csize) = self.__mem_store(fp)
+
+        fp.close()
+
+        f.dh.crc32 = crc
+        f.lh.crc32 = f.dh.crc32
         
-        f.dh.compressed_size = len(cbuf)
+        f.dh.compressed_size = csize
         f.lh.compressed_size = f.dh.compressed_size
-        # print('Compressed size: %u' % f.dh.compressed_size)
+        _log.debug('"%s": %u bytes, %u stored (compression %u)', f.filenameuc, fsize, csize, f.dh.compression)
 
         f.lh.compression = f.dh.compression
 
         f.dh.filename = final_name
         f.lh.filename = f.dh.filename
 
-        f.dh.offset = self.__mem.tell()
-        self.__mem.write(cbuf)
-        # print('Offset is now: %u' % self.__mem.tell())
-        
-        # f.dump()
-
         if on_dupe == mrs_dupe_behavior.KEEP_NEW and dup:
+            self.__unindex_name(dup[0])
             self.__files[dup[0]] = f
-            # self.__files[dup[0]].lh.dump()
+            self.__index_name(dup[0])
         else:
             self.__files.append(f)
+            self.__index_name(len(self.__files) - 1)
             self.__hdr.dir_count += 1
             self.__hdr.total_dir_count = self.__hdr.dir_count
     
+    def add_file(self, name: str, /, final_name: str = None, on_dupe: mrs_dupe_behavior = mrs_dupe_behavior.KEEP_NEW):
+        real_name = path.realpath(name)
+        _log.debug('Adding file "%s" (%s)', name, real_name)
+
+        if not final_name:
+            final_name = path.split(real_name)[1]
+        
+        self.__add_file(name, real_name, final_name, None, on_dupe)
+    
     def add_folder(self, name: str, /, base_name: str = None, on_dupe: mrs_dupe_behavior = mrs_dupe_behavior.KEEP_NEW):
-        # print(f'Adding folder "{name}"')
         real_path = path.realpath(name)
-        # print(f'Which real path is "{real_path}"')
+        _log.debug('Adding folder "%s" (%s)', name, real_path)
 
-        if not path.exists(real_path):
-            raise FileNotFoundError(f'"{name}" was not found.')
-        if not path.isdir(real_path):
+        try:
+            st = os.stat(real_path)
+        except OSError:
+            raise FileNotFoundError(f'"{name}" was not found.') from None
+        if not stat.S_ISDIR(st.st_mode):
             raise NotADirectoryError(f'"{name}" is not a directory.')
         
-        fl = glob(f'**', root_dir=real_path, recursive=True)
-        for i in fl:
-            fname = f'{real_path}/{i}'
+        for (fname, i, entry) in _walk_files(real_path):
             ffname = f'{base_name}/{i}' if base_name else i
-            # print(fname)
-            if path.isdir(fname):
-                # print(' <skipping dir>')
-                continue
-            self.add_file(fname, final_name=ffname, on_dupe=on_dupe)
+            self.__add_file(fname, fname, ffname, entry.stat(), on_dupe)
     
     # TODO: add_mrs
     def add_mrs(self, name: str, /, base_name: str = None, on_dupe: mrs_dupe_behavior = mrs_dupe_behavior.KEEP_NEW):
-        # print('Let\'s add files from a MRS archive')
         realpath = path.realpath(name)
-        # print(f'"{name}", which real path is "{realpath}"')
+        _log.debug('Adding archive "%s" (%s)', name, realpath)
 
-        if not path.exists(realpath):
-            raise FileNotFoundError(f'"{name}" was not found.')
+        try:
+            st = os.stat(realpath)
+        except OSError:
+            raise FileNotFoundError(f'"{name}" was not found.') from None
         
-        if path.isdir(realpath):
+        if stat.S_ISDIR(st.st_mode):
             raise IsADirectoryError(f'"{name}" is a directory.')
         
         fp = None
         try:
-            fp = open(realpath, 'rb')
+            fp = open(realpath, 'rb', buffering=_ARCHIVE_BUFFER_SIZE)
         except:
             raise IOError(f'Cannot open "{name}".')
         
@@ -915,13 +1132,12 @@ class mrs:
         hdr_b = fp.read(_mrs_hdr.size)
         hdr_b = _decrypt.base_hdr(hdr_b, _mrs_hdr.size)
 
-        hdr.read(hdr_b)
+        hdr._read_bytes(hdr_b)
 
         if (not self.__mrs_default_signatures(mrs_signature_where.BASE_HDR, hdr.signature)) and (not self.__sigcheck or not self.__sigcheck(mrs_signature_where.BASE_HDR, hdr.signature)):
             raise NotAMrsFileError(f'"{name}" is not a MRS file or the decryption is incorrect.')
 
-        # print('  Dir size: %u' % hdr.dir_size)
-        # print('Dir offset: %08x' % hdr.dir_offset)
+        _log.debug('Central directory: %u entries, %u bytes at %08x', hdr.dir_count, hdr.dir_size, hdr.dir_offset)
 
         fp.seek(hdr.dir_offset)
         cdir_b = fp.read(hdr.dir_size)
@@ -930,38 +1146,26 @@ class mrs:
             raise NotAMrsFileError(f'"{name}" is not a MRS file or is corrupted.')
         
         _files = []
-        cdir_b = _decrypt.central_dir_hdr(cdir_b, hdr.dir_size)
+        # Entries are parsed in place, only their name, extra and comment are copied out
+        cdir_b = memoryview(_decrypt.central_dir_hdr(cdir_b, hdr.dir_size))
         offset = 0
         for i in range(hdr.dir_count):
             f = _mrs_file()
-            # print(f'Reading file {i} header')
-            cdir = _mrs_central_dir_hdr()
-            f.dh.read(cdir_b)
+            f.dh._read_bytes(cdir_b, offset)
 
             if (not self.__mrs_default_signatures(mrs_signature_where.CENTRAL_DIR_HDR, f.dh.signature)) and (not self.__sigcheck or not self.__sigcheck(mrs_signature_where.CENTRAL_DIR_HDR, f.dh.signature)):
                 raise InvalidMrsEncryptionError(f'Invalid decryption for "{name}".')
             
             try:
+                if not f.dh.filename:
+                    raise UnicodeError
                 (f.filenameuc, f.filenameenc) = _dec_str(f.dh.filename)
-            except:
+            except UnicodeError:
                 raise UnicodeError(f'"{name}": Unknown encoding for {f.dh.filename} filename.') from None
-            # try:
-            #     f.filenameuc = f.dh.filename.decode('mbcs')
-            #     f.filenameenc = 'mbcs'
-            # except:
-            #     try:
-            #         f.filenameuc = f.dh.filename.decode('1252')
-            #         f.filenameenc = '1252'
-            #     except:
-            #         try:
-            #             f.filenameuc = f.dh.filename.decode('utf-8')
-            #             f.filenameenc = 'utf-8'
-            #         except:
-            #             raise UnicodeError(f'"{name}": Unknown encoding for {f.dh.filename} filename.')
+            stored_name = f.filenameuc
             
             if base_name:
                 f.filenameuc = f'{base_name}/{f.filenameuc}'
-                f.dh.filename = f.filenameuc.encode(f.filenameenc)
 
             try:
                 _is_valid_filename(f.filenameuc)
@@ -972,7 +1176,7 @@ class mrs:
             lhdr_b = fp.read(_mrs_local_hdr.size) # Local header bytes
             lhdr_b = _decrypt.local_hdr(lhdr_b, _mrs_local_hdr.size)
 
-            f.lh.read(lhdr_b)
+            f.lh._read_bytes(lhdr_b)
             # lhdr = _mrs_local_hdr()
             # lhdr.read(lhdr_b)
             
@@ -983,36 +1187,24 @@ class mrs:
             fp.seek(f.lh.filename_length, io.SEEK_CUR)
             if f.lh.extra_length:
                 _extra = fp.read(f.lh.extra_length)
-                f.lh.extra = self.__mrs_default_decrypt(_extra, f.lh.extra_length)
+                f.lh.extra = bytes(_decrypt.local_hdr(_extra, f.lh.extra_length))
             
             # Now let's read the file content
             # NOTE: Should it give an error for 'compression' field value different from 0 and 8 ?
             # We skip zero-byte files for decompression and/or reading
             f.dh.offset = 0
             if f.dh.compressed_size != 0:
-                f.dh.offset = self.__mem.tell()
-                # print(f.dh.offset)
-                # print(f.dh.compressed_size)
+                f.dh.offset = self.__mem_end
                 fbuf = fp.read(f.dh.compressed_size)
                 # NOTE: Does it work?
                 if _decrypt.buffer:
                     fbuf = _decrypt.buffer(fbuf, f.dh.compressed_size)
                 if f.dh.compression == self.COMPRESSION_DEFLATE:
-                    # print('Compression method: DEFLATE')
-                    # fbuf = fp.read(f.dh.compressed_size)
-                    # print(fbuf)
-                    try:
-                        ffbuf = zlib.decompress(fbuf, -15)
-                    except:
+                    if not _is_valid_deflate(fbuf):
                         raise zlib.error(f'Invalid DEFLATE stream at "{name}" for the archived file named "{f.dh.filename}".')
-                    self.__mem.seek(0, io.SEEK_END)
-                    self.__mem.write(fbuf)
+                    self.__mem_write(fbuf)
                 else:
-                    # print('Compression method: STORE')
-                    # fbuf = fp.read(f.dh.compressed_size)
-                    self.__mem.seek(0, io.SEEK_END)
-                    self.__mem.write(fbuf)
-                    # print(fbuf)
+                    self.__mem_write(fbuf)
 
             dup = self.__is_duplicate(f.filenameuc)
             if dup:
@@ -1021,33 +1213,35 @@ class mrs:
                 elif on_dupe == mrs_dupe_behavior.KEEP_BOTH:
                     f.filenameuc = dup[1]
 
-            # print(offset, f'({f.dh.size}, {f.dh.filename_length}, {f.dh.extra_length}, {f.dh.comment_length})')
             offset_next = (f.dh.size + f.dh.filename_length + f.dh.extra_length + f.dh.comment_length)
 
-            # Update file name
+            # Update file name, only re-encoding it if it was changed
             f.filenameuc = f.filenameuc.replace('/', '\\')
-            f.dh.filename = f.filenameuc.encode(f.filenameenc)
-            f.dh.filename_length = len(f.dh.filename)
+            if f.filenameuc != stored_name:
+                f.dh.filename = f.filenameuc.encode(f.filenameenc)
+                f.dh.filename_length = len(f.dh.filename)
             f.lh.filename = f.dh.filename
-            f.lh.filename_length = len(f.lh.filename)
+            f.lh.filename_length = f.dh.filename_length
             
             _files.append((f, dup))
 
-            cdir_b = cdir_b[offset_next:]
+            offset += offset_next
         
-        # print('ALL FILES OK!')
-
+        to_append = []
         for (i,j) in _files:
             if j and on_dupe==mrs_dupe_behavior.KEEP_NEW:
-                # print('Found duplicate')
+                self.__unindex_name(j[0])
                 self.__files[j[0]] = i
+                self.__index_name(j[0])
             else:
-                # print(i.filenameuc, i.filenameenc)
-                # print(i.dh.dump())
-                # print(i.lh.dump())
-                self.__files.append(i)
-                self.__hdr.dir_count += 1
-                self.__hdr.total_dir_count = self.__hdr.dir_count
+                to_append.append(i)
+        
+        first = len(self.__files)
+        self.__files.extend(to_append)
+        for index in range(first, len(self.__files)):
+            self.__index_name(index)
+        self.__hdr.dir_count += len(to_append)
+        self.__hdr.total_dir_count = self.__hdr.dir_count
         
         fp.close()
 
@@ -1058,12 +1252,17 @@ class mrs:
         if index >= self.__hdr.dir_count:
             raise IndexError(f'Out of bound index, there\'s no file at index {index}.')
         
-        # print(f'Trying to read file at index {index}')
-        b = self.__mem_read(self.__files[index].dh.offset, self.__files[index].dh.compressed_size)
-        # print(self.__files[index].dh.offset, self.__files[index].dh.compressed_size, b)
-        if self.__files[index].dh.compression == mrs.COMPRESSION_DEFLATE:
-            b = zlib.decompress(b, -15)
-        return b
+        dh = self.__files[index].dh
+        if dh.compression != mrs.COMPRESSION_DEFLATE:
+            return self.__mem_read(dh.offset, dh.compressed_size)
+        # Size the output buffer up front so it never has to grow
+        bufsize = max(dh.uncompressed_size, 1)
+        if self.__mem_disk:
+            return zlib.decompress(self.__mem_read(dh.offset, dh.compressed_size), -15, bufsize)
+        # Inflate straight from the in-memory buffer, without copying the entry out first
+        self.__mem_check(dh.offset, dh.compressed_size)
+        with self.__mem.getbuffer() as buf, buf[dh.offset:dh.offset + dh.compressed_size] as b:
+            return zlib.decompress(b, -15, bufsize)
     
     def set_decryption(self, *, base_hdr=NotAssigned, local_hdr=NotAssigned, central_dir_hdr=NotAssigned, buffer=NotAssigned):
         if base_hdr != NotAssigned:
@@ -1135,7 +1334,9 @@ class mrs:
             raise IndexError(f'Out of bound index, there\'s no file at index {index}.')
         
         # name
+        self.__unindex_name(index)
         self.__files[index].filenameuc = file.name
+        self.__index_name(index)
         (self.__files[index].dh.filename, self.__files[index].filenameenc) = _enc_str(file.name)
         self.__files[index].lh.filename = self.__files[index].dh.filename
         self.__files[index].dh.filename_length = len(self.__files[index].dh.filename)
@@ -1155,17 +1356,19 @@ class mrs:
         self.__files[index].dh.comment_length = len(file.dh_comment) if file.dh_comment else 0
     
     def get_files(self):
-        for i in self.__files:
-            yield mrs_file(index=self.__files.index(i), name=i.filenameuc, crc32=i.dh.crc32, compressed_size=i.dh.compressed_size, size=i.dh.uncompressed_size, ftime=i.dh.filetime.mktimedos(), lhextra=i.lh.extra, dhextra=i.dh.extra, dhcomment=i.dh.comment)
+        for (index, i) in enumerate(self.__files):
+            yield mrs_file(index=index, name=i.filenameuc, crc32=i.dh.crc32, compressed_size=i.dh.compressed_size, size=i.dh.uncompressed_size, ftime=i.dh.filetime.mktimedos(), lhextra=i.lh.extra, dhextra=i.dh.extra, dhcomment=i.dh.comment)
     
     def save_mrs(self, filename: str):
-        # print(f'Saving mrs file: {filename}')
         rfilename = path.realpath(filename)
-        # print(f'Which real path is {rfilename}')
-        if path.exists(rfilename) and not path.isfile(rfilename):
+        _log.debug('Saving %u file(s) to "%s" (%s)', len(self.__files), filename, rfilename)
+        try:
+            st = os.stat(rfilename)
+        except OSError:
+            st = None
+        if st and not stat.S_ISREG(st.st_mode):
             raise IsADirectoryError(f'"{rfilename}" already exists, and it is a folder.')
         
-        # print(f'We have {self.get_file_count()} file(s)')
         hdr = self.__hdr
 
         _encrypt = mrs_encryption()
@@ -1187,7 +1390,6 @@ class mrs:
             blh = i.lh.write()
             blh = _encrypt.local_hdr(blh, _mrs_local_hdr.size)
             f.write(blh)
-            # print(blh.hex())
             if i.lh.filename_length != 0:
                 bfilename = i.lh.filename
                 bfilename = _encrypt.local_hdr(bfilename, i.lh.filename_length)
@@ -1202,18 +1404,14 @@ class mrs:
             f.write(bf)
             offset += _mrs_local_hdr.size + i.lh.filename_length + i.lh.extra_length + i.lh.compressed_size
         
-        # print('Offset is now %08x' % offset)
         hdr.dir_offset = offset
-        dhbuf = bytearray()
+        dhsize = 0
         for i in self.__files:
-            dh = i.dh
-            dh.offset = offsets[self.__files.index(i)]
-            dhbuf += dh.write()
-            dhbuf += dh.filename
-            if dh.extra:
-                dhbuf += dh.extra
-            if dh.comment:
-                dhbuf += dh.comment
+            dhsize += i.dh.record_size()
+        dhbuf = bytearray(dhsize)
+        pos = 0
+        for (i, lh_offset) in zip(self.__files, offsets):
+            pos = i.dh.write_into(dhbuf, pos, lh_offset)
         
         hdr.dir_size = len(dhbuf)
         dhbuf = _encrypt.central_dir_hdr(dhbuf, len(dhbuf))
@@ -1226,23 +1424,25 @@ class mrs:
         f.close()
     
     def save_folder(self, filename: str):
-        # print(f'Let\'s extract files to "{filename}"')
         rfilename = path.realpath(filename)
-        # print(f'Which real path is "{rfilename}"')
-        if path.exists(rfilename) and not path.isdir(rfilename):
+        _log.debug('Extracting %u file(s) to "%s" (%s)', len(self.__files), filename, rfilename)
+        try:
+            st = os.stat(rfilename)
+        except OSError:
+            st = None
+        if st and not stat.S_ISDIR(st.st_mode):
             raise NotADirectoryError(f'Cannot save to "{filename}", "{filename}" exists and is not a directory.')
         
         for i in self.__files:
             outname = f'{filename}/{i.filenameuc}'
             os.makedirs(path.split(outname)[0], exist_ok=True)
-            b = self.read(self.__files.index(i))
             f = None
             try:
                 f = open(outname, 'wb')
             except:
-                print(f'Warning: Cannot save "{outname}".', file=sys.stderr)
+                _log.warning('Cannot save "%s".', outname)
                 continue
-            f.write(b)
+            self.__mem_extract(i, f)
             f.close()
 
 # TODO: Custom signatures
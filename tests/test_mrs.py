@@ -0,0 +1,48 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mrs
+
+
+class DuplicateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.src = os.path.join(self.tmp.name, 'src.txt')
+        with open(self.src, 'wb') as f:
+            f.write(b'content')
+
+    def rename(self, m, index, name):
+        f = list(m.get_files())[index]
+        f.name = name
+        m.set_file(index, f)
+
+    def test_rename_keeps_other_entry_with_same_name(self):
+        m = mrs.mrs()
+        m.add_file(self.src, final_name='a.txt')
+        m.add_file(self.src, final_name='b.txt')
+        self.rename(m, 1, 'a.txt')
+        self.rename(m, 1, 'c.txt')
+
+        with self.assertRaises(ValueError):
+            m.add_file(self.src, final_name='a.txt', on_dupe=mrs.mrs_dupe_behavior.KEEP_OLD)
+        self.assertEqual([f.name for f in m.get_files()], ['a.txt', 'c.txt'])
+
+    def test_keep_both_suffix_survives_rename(self):
+        m = mrs.mrs()
+        m.add_file(self.src, final_name='a.txt')
+        m.add_file(self.src, final_name='a (2).txt')
+        m.add_file(self.src, final_name='b.txt')
+        self.rename(m, 2, 'a (2).txt')
+        self.rename(m, 2, 'b.txt')
+
+        m.add_file(self.src, final_name='a.txt', on_dupe=mrs.mrs_dupe_behavior.KEEP_BOTH)
+        self.assertEqual([f.name for f in m.get_files()], ['a.txt', 'a (2).txt', 'b.txt', 'a (3).txt'])
+
+
+if __name__ == '__main__':
+    unittest.main()